@@ -7,18 +7,27 @@
 # Description:
 #   Functions for running kalman filters on pedestrian trajectory data.
 #
+#   model_matrices builds the (constant) F, H, Q, R and initial P
+#
 #   kalman_filter allows you to specify a Kalman Filter which possibly operates
 #   over multiple 'sensors', e.g. two cameras
 #
-#   run_filter runs a kalman filter over a dataframe (for just one pedestrian)
+#   run_filter runs a kalman filter over a dataframe (for just one pedestrian),
+#   the dataframe only holds one sensor's x/y, so the filter must have nsensors=1
 #
 #   kalman runs a kalman filter over multiple pedestrians
 #
+#   kalman_batch and rts_batch are numba-compiled versions of the filter and
+#   smoother for the single sensor case (dim_x=6, dim_z=2) with a constant
+#   model, built from the predict_6x2/update_6x2 kernels. kalman and
+#   run_filter use these instead of filterpy.
+#
 #   If you have a dataframe with columns=[frame, trackingId, x, y]
 #   Then, you can simply call kalman(df)
 #
 # Dependencies:
 #   - filterpy
+#   - numba
 #   - numpy
 #   - pandas
 #   - scipy
@@ -28,70 +37,237 @@
 from filterpy.kalman import KalmanFilter
 from filterpy.common import Q_discrete_white_noise
 from scipy.linalg import block_diag
+import numba
 import numpy as np
 import pandas as pd
 
-def kalman_filter(sx, sy, dt = 1./30., nsensors=1):
+def model_matrices(dt = 1./30., nsensors=1):
     R_std = 15
     Q_std = 15
 
-    kfilter = KalmanFilter(dim_x=6, dim_z=2 * nsensors)
-    kfilter.F = np.array([[1, dt, 0.5*dt*dt,  0,  0,          0],
-                          [0,  1,        dt,  0,  0,          0],
-                          [0,  0,         1,  0,  0,          0],
-                          [0,  0,         0,  1,  dt, 0.5*dt*dt],
-                          [0,  0,         0,  0,  1,         dt],
-                          [0,  0,         0,  0,  0,          1]])
-
-    kfilter.u = 0.
-    kfilter.H = np.tile(
+    F = np.array([[1, dt, 0.5*dt*dt,  0,  0,          0],
+                  [0,  1,        dt,  0,  0,          0],
+                  [0,  0,         1,  0,  0,          0],
+                  [0,  0,         0,  1,  dt, 0.5*dt*dt],
+                  [0,  0,         0,  0,  1,         dt],
+                  [0,  0,         0,  0,  0,          1]], dtype=np.float64)
+    H = np.tile(
         np.array(
             [[1, 0, 0, 0, 0, 0],
-             [0, 0, 0, 1, 0, 0]]
+             [0, 0, 0, 1, 0, 0]],
+            dtype=np.float64
         ),
         (nsensors, 1)
     )
-
-    kfilter.R = np.eye(2 * nsensors) * R_std**2
+    R = np.eye(2 * nsensors) * R_std**2
     q = Q_discrete_white_noise(dim=3, dt=dt, var=Q_std**2)
-    kfilter.Q = block_diag(q, q)
+    Q = block_diag(q, q)
+    P = np.eye(6) * 15
+    return F, H, Q, R, P
+
+def kalman_filter(sx, sy, dt = 1./30., nsensors=1):
+    kfilter = KalmanFilter(dim_x=6, dim_z=2 * nsensors)
+    kfilter.F, kfilter.H, kfilter.Q, kfilter.R, kfilter.P = model_matrices(dt, nsensors)
+    kfilter.u = 0.
     kfilter.x = np.array([[sx, 0, 0, sy, 0, 0]]).T  # type: ignore
-    kfilter.P = np.eye(6) * 15
     return kfilter
 
 def run_filter(kfilter, df):
-    blocks = (pd.isna(df["x"]) != pd.isna(df["x"].shift())).cumsum()
-    ms = []
-    cs = []
-    for _, gdf in df.groupby(blocks):
-        if pd.isna(gdf["x"].iloc[0]) or pd.isna(gdf["y"].iloc[0]):
-            m, c, _, _ = kfilter.batch_filter([None] * len(gdf))
+    if kfilter.dim_z != 2:
+        # df only carries one x/y measurement per frame
+        raise ValueError(
+            f"run_filter only supports single sensor filters (dim_z=2), got dim_z={kfilter.dim_z}"
+        )
+    z = df[["x", "y"]].to_numpy(dtype=np.float64)
+    mu, cov = kalman_batch(
+        np.asarray(kfilter.x, dtype=np.float64).reshape(6),
+        np.asarray(kfilter.F, dtype=np.float64),
+        np.asarray(kfilter.H, dtype=np.float64),
+        np.asarray(kfilter.Q, dtype=np.float64),
+        np.asarray(kfilter.R, dtype=np.float64),
+        np.asarray(kfilter.P, dtype=np.float64),
+        z,
+        np.isnan(z).any(axis=1),
+    )
+    if len(mu):
+        # leave the filter where batch_filter would have
+        kfilter.x = mu[-1].reshape(6, 1)
+        kfilter.P = cov[-1].copy()
+    return mu[:, :, np.newaxis], cov
+
+KALMAN_COLUMNS = [
+    "kalman_x", "kalman_dx_dt", "kalman_dx_dt_dt",
+    "kalman_y", "kalman_dy_dt", "kalman_dy_dt_dt",
+]
+RTS_COLUMNS = [
+    "rts_x", "rts_dx_dt", "rts_dx_dt_dt",
+    "rts_y", "rts_dy_dt", "rts_dy_dt_dt",
+]
+
+@numba.njit(cache=True, inline="always")
+def predict_6x2(x, P, F, Q, x_out, P_out, FP):
+    """
+    x_out = Fx, P_out = FPF' + Q, with F times P left in FP.
+    The outputs must not alias x or P.
+    """
+    for i in range(6):
+        s = 0.
+        for k in range(6):
+            s += F[i, k] * x[k]
+        x_out[i] = s
+        for j in range(6):
+            s = 0.
+            for k in range(6):
+                s += F[i, k] * P[k, j]
+            FP[i, j] = s
+    for i in range(6):
+        for j in range(6):
+            s = Q[i, j]
+            for k in range(6):
+                s += FP[i, k] * F[j, k]
+            P_out[i, j] = s
+
+@numba.njit(cache=True, inline="always")
+def update_6x2(x, P, z, H, R, x_out, P_out, W):
+    """
+    S = HPH' + R, K = PH'S^-1, x_out = x + K(z - Hx)
+    P_out in joseph form: (I - KH)P(I - KH)' + KRK'
+    The outputs may alias x and P. W is a (4, 6, 6) scratch buffer laid out as
+    W[0, :, :2] = PH', W[1, :, :2] = K, W[2] = I - KH, W[3] = (I - KH)P.
+    It is indexed directly rather than through views, each extra array
+    handed around in the per-frame loop costs a refcount.
+    """
+    for i in range(6):
+        s0 = 0.
+        s1 = 0.
+        for k in range(6):
+            s0 += P[i, k] * H[0, k]
+            s1 += P[i, k] * H[1, k]
+        W[0, i, 0] = s0
+        W[0, i, 1] = s1
+    s00 = R[0, 0]
+    s01 = R[0, 1]
+    s10 = R[1, 0]
+    s11 = R[1, 1]
+    y0 = z[0]
+    y1 = z[1]
+    for k in range(6):
+        s00 += H[0, k] * W[0, k, 0]
+        s01 += H[0, k] * W[0, k, 1]
+        s10 += H[1, k] * W[0, k, 0]
+        s11 += H[1, k] * W[0, k, 1]
+        y0 -= H[0, k] * x[k]
+        y1 -= H[1, k] * x[k]
+    det = s00 * s11 - s01 * s10
+    si00 = s11 / det
+    si01 = -s01 / det
+    si10 = -s10 / det
+    si11 = s00 / det
+
+    for i in range(6):
+        W[1, i, 0] = W[0, i, 0] * si00 + W[0, i, 1] * si10
+        W[1, i, 1] = W[0, i, 0] * si01 + W[0, i, 1] * si11
+        x_out[i] = x[i] + W[1, i, 0] * y0 + W[1, i, 1] * y1
+
+    for i in range(6):
+        for j in range(6):
+            W[2, i, j] = (1. if i == j else 0.) - W[1, i, 0] * H[0, j] - W[1, i, 1] * H[1, j]
+    for i in range(6):
+        for j in range(6):
+            s = 0.
+            for k in range(6):
+                s += W[2, i, k] * P[k, j]
+            W[3, i, j] = s
+    for i in range(6):
+        for j in range(6):
+            s = (
+                W[1, i, 0] * (R[0, 0] * W[1, j, 0] + R[0, 1] * W[1, j, 1]) +
+                W[1, i, 1] * (R[1, 0] * W[1, j, 0] + R[1, 1] * W[1, j, 1])
+            )
+            for k in range(6):
+                s += W[3, i, k] * W[2, j, k]
+            P_out[i, j] = s
+
+@numba.njit(cache=True)
+def kalman_batch(x0, F, H, Q, R, P0, z, mask):
+    """
+    z is (T, 2); frames where mask is True are predict-only.
+    Returns the posterior means (T, 6) and covariances (T, 6, 6).
+    """
+    T = z.shape[0]
+    mu = np.empty((T, 6))
+    cov = np.empty((T, 6, 6))
+    x = x0.copy()
+    P = P0.copy()
+    xp = np.empty(6)
+    Pp = np.empty((6, 6))
+    FP = np.empty((6, 6))
+    W = np.empty((4, 6, 6))
+    for t in range(T):
+        predict_6x2(x, P, F, Q, xp, Pp, FP)
+        if mask[t]:
+            x[:] = xp
+            P[:] = Pp
         else:
-            m, c, _, _ = kfilter.batch_filter(gdf[["x", "y"]].values)
-        ms.append(m)
-        cs.append(c)
-    return np.vstack(ms), np.vstack(cs)
+            update_6x2(xp, Pp, z[t], H, R, x, P, W)
+        mu[t] = x
+        cov[t] = P
+    return mu, cov
 
-def kalman(df: pd.DataFrame) -> pd.DataFrame:
-    for trackingId, gdf in df.groupby("trackingId"):
-        start_idx = ~(pd.isna(gdf.x) | pd.isna(gdf.y))
-        init_x = gdf.loc[start_idx].x.iloc[0]
-        init_y = gdf.loc[start_idx].y.iloc[0]
-        kfilter = kalman_filter(init_x, init_y, dt = 1/30)
-        mu, cov = run_filter(kfilter, gdf)
-        
-        df.loc[gdf.index, "kalman_x"] = mu[:, 0, 0]
-        df.loc[gdf.index, "kalman_dx_dt"] = mu[:, 1, 0]
-        df.loc[gdf.index, "kalman_dx_dt_dt"] = mu[:, 2, 0]
-        df.loc[gdf.index, "kalman_y"] = mu[:, 3, 0]
-        df.loc[gdf.index, "kalman_dy_dt"] = mu[:, 4, 0]
-        df.loc[gdf.index, "kalman_dy_dt_dt"] = mu[:, 5, 0]
+@numba.njit(cache=True)
+def rts_batch(mu, cov, F, Q):
+    """
+    Rauch-Tung-Striebel backward pass over the output of kalman_batch.
+    """
+    T = mu.shape[0]
+    x = mu.copy()
+    P = cov.copy()
+    xp = np.empty(6)
+    Pp = np.empty((6, 6))
+    FP = np.empty((6, 6))
+    dP = np.empty((6, 6))
+    KdP = np.empty((6, 6))
+    for t in range(T - 2, -1, -1):
+        predict_6x2(x[t], P[t], F, Q, xp, Pp, FP)
+        # K = PF'Pp^-1, i.e. K' = Pp^-1 FP since Pp is symmetric
+        K = np.linalg.solve(Pp, FP).T
+        for i in range(6):
+            s = 0.
+            for k in range(6):
+                s += K[i, k] * (x[t + 1, k] - xp[k])
+            x[t, i] += s
+        for i in range(6):
+            for j in range(6):
+                dP[i, j] = P[t + 1, i, j] - Pp[i, j]
+        for i in range(6):
+            for j in range(6):
+                s = 0.
+                for k in range(6):
+                    s += K[i, k] * dP[k, j]
+                KdP[i, j] = s
+        for i in range(6):
+            for j in range(6):
+                s = 0.
+                for k in range(6):
+                    s += KdP[i, k] * K[j, k]
+                P[t, i, j] += s
+    return x, P
 
-        mu_rts, cov_rts, _, _ = kfilter.rts_smoother(mu, cov)
-        df.loc[gdf.index, "rts_x"] = mu_rts[:, 0, 0]
-        df.loc[gdf.index, "rts_dx_dt"] = mu_rts[:, 1, 0]
-        df.loc[gdf.index, "rts_dx_dt_dt"] = mu_rts[:, 2, 0]
-        df.loc[gdf.index, "rts_y"] = mu_rts[:, 3, 0]
-        df.loc[gdf.index, "rts_dy_dt"] = mu_rts[:, 4, 0]
-        df.loc[gdf.index, "rts_dy_dt_dt"] = mu_rts[:, 5, 0]
-    return df
\ No newline at end of file
+def kalman(df: pd.DataFrame) -> pd.DataFrame:
+    F, H, Q, R, P0 = model_matrices(dt = 1/30)
+    xy = df[["x", "y"]].to_numpy(dtype=np.float64)
+    out = np.full((len(df), 12), np.nan)
+    tracks = df["trackingId"].astype("category")
+    groups = df.groupby(tracks, sort=False, observed=True).indices
+    for trackingId, idx in groups.items():
+        z = xy[idx]
+        missing = np.isnan(z).any(axis=1)
+        init_x, init_y = z[~missing][0]
+        x0 = np.array([init_x, 0., 0., init_y, 0., 0.])
+        mu, cov = kalman_batch(x0, F, H, Q, R, P0, z, missing)
+        mu_rts, _ = rts_batch(mu, cov, F, Q)
+        out[idx, :6] = mu
+        out[idx, 6:] = mu_rts
+    for i, col in enumerate(KALMAN_COLUMNS + RTS_COLUMNS):
+        df[col] = out[:, i]
+    return df
@@ -20,6 +20,9 @@
 #   Estimate the camera intrinsics using the intrinsic-calibration tool
 #   If you have a fisheye camera, you will need to add the --fisheye flag
 #   in order to use the appropriate mathematical camera model.
+#   Calibrations are cached in $XDG_CACHE_HOME/iw (default ~/.cache/iw), so
+#   re-running on the same images is instant. Add --no-cache to force a
+#   recalibration (--viz always does).
 #
 #   python pixelmapper.py intrinsic-calibration \
 #       --input file_with_checkerboard_images \
@@ -74,9 +77,13 @@
 # =============================================================================
 
 
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import glob
-import pathlib
+import hashlib
+import os
 import pickle
+import tempfile
 
 import click
 import cv2 as cv
@@ -88,42 +95,77 @@ import matplotlib.pyplot as plt
 # computer vision tools
 ################################################################################
 
+# chessboard detection and calibration settings, these are hashed into the
+# intrinsic calibration cache key (see _intrinsic_cache_file)
+CHESSBOARD = (9, 6)
+DETECT_IMREAD = cv.IMREAD_REDUCED_GRAYSCALE_2
+# findChessboardCorners' default flags plus a fast check, so images without a
+# board are rejected before the exhaustive search
+DETECT_FLAGS = cv.CALIB_CB_ADAPTIVE_THRESH + cv.CALIB_CB_NORMALIZE_IMAGE + cv.CALIB_CB_FAST_CHECK
+SUBPIX_WINDOW = (11, 11)
+SUBPIX_CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+CALIB_FLAGS = cv.CALIB_USE_LU
+# bump whenever _find_chessboard_corners or _intrinsic_calibration change,
+# including the fisheye settings that are set inline there
+INTRINSIC_CACHE_VERSION = 2
+
 def pad(X, val = 1):
-    return np.pad(X, ((0, 0), (0, 1)), constant_values=val).T
+    out = np.empty((X.shape[1] + 1, X.shape[0]), dtype=X.dtype)
+    out[:-1] = X.T
+    out[-1] = val
+    return out
 
 def _extrinsic_calibration(pts_src, pts_dst):
     h, _ = cv.findHomography(pts_src, pts_dst, cv.RANSAC, 5.0)
     return h
 
 def pixels2world(homography_h, pts_pixels):
-    return cv.perspectiveTransform(pts_pixels.reshape(-1, 1, 2), homography_h)[:,0,:]
-
-def _intrinsic_calibration(images, visualize = False, fisheye = False):
-    # termination criteria
-    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    return cv.perspectiveTransform(pts_pixels.reshape(-1, 1, 2), homography_h).reshape(-1, 2)
+
+def _find_chessboard_corners(fname, full_res_fallback=False):
+    # Find the chess board corners on a half resolution image, optionally
+    # falling back to a (slow) full resolution search if the board isn't found.
+    # The image shape is None when no board was found.
+    small = cv.imread(fname, DETECT_IMREAD)
+    ret, corners = cv.findChessboardCorners(small, CHESSBOARD, None, DETECT_FLAGS)
+    if ret == True:
+        # pixel centers of the half resolution image sit at 2x + 0.5
+        corners = corners * 2 + 0.5
+    elif not full_res_fallback:
+        return None, ret, corners
+    gray = cv.imread(fname, cv.IMREAD_GRAYSCALE)
+    if ret != True:
+        ret, corners = cv.findChessboardCorners(gray, CHESSBOARD, None)
+    # If found, refine them at full resolution
+    if ret == True:
+        corners = cv.cornerSubPix(gray,corners, SUBPIX_WINDOW, (-1,-1), SUBPIX_CRITERIA)
+    return gray.shape, ret, corners
+
+def _intrinsic_calibration(images, visualize = False, fisheye = False, full_res_fallback = False):
     # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-    objp = np.zeros((6*9,3), np.float32)
-    objp[:,:2] = np.mgrid[0:9,0:6].T.reshape(-1,2)
+    objp = np.zeros((CHESSBOARD[0]*CHESSBOARD[1],3), np.float32)
+    objp[:,:2] = np.mgrid[0:CHESSBOARD[0],0:CHESSBOARD[1]].T.reshape(-1,2)
     # Arrays to store object points and image points from all the images.
     objpoints = [] # 3d point in real world space
     imgpoints = [] # 2d points in image plane.
-    for fname in images:
-        img = cv.imread(fname)
-        h, w = img.shape[:2]
-        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-        # Find the chess board corners
-        ret, corners = cv.findChessboardCorners(gray, (9,6), None)
-        # If found, add object points, image points (after refining them)
+    # opencv releases the GIL, so images can be searched for corners in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        detections = list(pool.map(_find_chessboard_corners, images, [full_res_fallback] * len(images)))
+    for fname, (shape, ret, corners2) in zip(images, detections):
+        # If found, add object points, image points
         if ret == True:
+            h, w = shape
             objpoints.append(objp)
-            corners2 = cv.cornerSubPix(gray,corners, (11,11), (-1,-1), criteria)
             imgpoints.append(corners2)
             if not visualize: continue
             # Draw and display the corners
-            cv.drawChessboardCorners(img, (9,6), corners2, ret)
+            img = cv.imread(fname)
+            cv.drawChessboardCorners(img, CHESSBOARD, corners2, ret)
             cv.imshow('img', img)
             cv.waitKey(500)
     cv.destroyAllWindows()
+    if not objpoints:
+        raise ValueError("no chessboard found in any of the calibration images")
 
     if fisheye:
         N_OK = len(objpoints)
@@ -137,7 +179,7 @@ def _intrinsic_calibration(images, visualize = False, fisheye = False):
             cv.fisheye.calibrate(
                 objpoints,
                 imgpoints,
-                gray.shape[::-1],
+                (w, h),
                 K,
                 D,
                 rvecs,
@@ -148,24 +190,59 @@ def _intrinsic_calibration(images, visualize = False, fisheye = False):
         newcameramtx = cv.fisheye.estimateNewCameraMatrixForUndistortRectify(mtx, dist, (w, h), R=np.eye(3), balance=1.0)
         roi = None
     else:
-        ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+        ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, (w, h), None, None, flags=CALIB_FLAGS)
         newcameramtx, roi = cv.getOptimalNewCameraMatrix(mtx, dist, (w,h), None, None)
     return mtx, dist, newcameramtx, roi
 
-def _undistort_fisheye(img, K, D, balance=0.0, dim2=None, dim3=None):
-    h, w = img.shape[:2]
-    dim1 = img.shape[:2][::-1]  #dim1 is the dimension of input image to un-distort
-    assert dim1[0]/dim1[1] == w/h, "Image to undistort needs to have same aspect ratio as the ones used in calibration"
+def _build_fisheye_maps(K, D, size, balance=0.0, dim2=None, dim3=None):
+    dim1 = tuple(size)  #dim1 is the dimension of input image to un-distort, (w, h)
     if not dim2:
         dim2 = dim1
     if not dim3:
         dim3 = dim1
-    scaled_K = K * dim1[0] / w  # The values of K is to scale with image dimension.
+    scaled_K = K.copy()  # K is used as is, the maps are built at the calibration image size
     scaled_K[2][2] = 1.0  # Except that K[2][2] is always 1.0    # This is how scaled_K, dim2 and balance are used to determine the final K used to un-distort image. OpenCV document failed to make this clear!
     new_K = cv.fisheye.estimateNewCameraMatrixForUndistortRectify(scaled_K, D, dim2, np.eye(3), balance=balance)
-    map1, map2 = cv.fisheye.initUndistortRectifyMap(scaled_K, D, np.eye(3), new_K, dim3, cv.CV_16SC2)
+    return cv.fisheye.initUndistortRectifyMap(scaled_K, D, np.eye(3), new_K, dim3, cv.CV_16SC2)
+
+def _apply_maps(img, map1, map2):
     return cv.remap(img, map1, map2, interpolation=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
 
+def _undistort_fisheye(img, K, D, balance=0.0, dim2=None, dim3=None):
+    h, w = img.shape[:2]
+    map1, map2 = _build_fisheye_maps(K, D, (w, h), balance, dim2, dim3)
+    return _apply_maps(img, map1, map2)
+
+def _intrinsic_cache_file(images, fisheye, full_res_fallback):
+    # keyed on the calibration code and settings, the OpenCV version, the
+    # camera model and each image's path, size and modification time
+    settings = (
+        INTRINSIC_CACHE_VERSION, cv.__version__, CHESSBOARD, DETECT_IMREAD,
+        DETECT_FLAGS, SUBPIX_WINDOW, SUBPIX_CRITERIA, CALIB_FLAGS, fisheye,
+        full_res_fallback,
+    )
+    key = hashlib.blake2b(repr(settings).encode(), digest_size=16)
+    for fname in sorted(images):
+        stat = os.stat(fname)
+        key.update(f"{os.path.abspath(fname)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    # an empty XDG_CACHE_HOME counts as unset
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_root, "iw", "intrinsic", key.hexdigest() + ".pkl")
+
+def _write_intrinsic_cache(cache_file, calibration):
+    # dump to a temp file next to the cache and rename it into place, so an
+    # interrupted or concurrent run never leaves a truncated pickle behind
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(calibration, f)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
 class PixelMapper:
     def __init__(self,
                  intrinsic_mtx=None,
@@ -178,8 +255,19 @@ class PixelMapper:
         self.newcameramtx = newcameramtx
         self.homography = homography
         self.fisheye = fisheye
+        # undistortPoints is the identity for a pinhole camera with no
+        # distortion whose points are re-projected with the same matrix
+        self._identity_undistort = (
+            intrinsic_mtx is not None
+            and not fisheye
+            and (distortion is None or not np.any(distortion))
+            and newcameramtx is not None
+            and np.array_equal(newcameramtx, intrinsic_mtx)
+        )
 
     def undistort(self, X):
+        if self._identity_undistort:
+            return X
         if self.intrinsic_mtx is not None:
             if self.fisheye:
                 return cv.fisheye.undistortPoints(X, self.intrinsic_mtx, self.distortion, None, self.newcameramtx)
@@ -188,11 +276,12 @@ class PixelMapper:
 
     def __call__(self, X):
         """
-        make sure you do .reshape(-1, 1, 2)
+        X can be (N, 2) or (N, 1, 2), returns (N, 2)
         """
+        X = np.ascontiguousarray(X).reshape(-1, 1, 2)
         if self.intrinsic_mtx is not None:
             X = self.undistort(X)
-        return cv.perspectiveTransform(X, self.homography)[:,0,:]
+        return cv.perspectiveTransform(X, self.homography).reshape(-1, 2)
 
 ################################################################################
 # command line utilities
@@ -207,9 +296,10 @@ def cli():
 @click.option("--intrinsic", "-imap", type=click.Path(exists=True), required=False, help="intrinsic calibration")
 @click.option("--output", "-o", type=click.Path(exists=False), required=True, help="the name of the file to write calibration to")
 def extrinsic_calibration(input, intrinsic, output):
-    df = pd.read_csv(input)
-    pts_pixels = np.array(df.loc[:, ["px", "py"]], np.float32)
-    pts_world = np.array(df.loc[:, ["wx", "wy"]], np.float32)
+    with open(input, newline="") as f:
+        rows = list(csv.DictReader(f))
+    pts_pixels = np.array([[row["px"], row["py"]] for row in rows], np.float32)
+    pts_world = np.array([[row["wx"], row["wy"]] for row in rows], np.float32)
 
     if intrinsic:
         with open(intrinsic, "rb") as f:
@@ -247,15 +337,17 @@ def extrinsic_calibration(input, intrinsic, output):
         print("---------------------")
         print("Errors")
         print("---------------------")
-        print("l2", np.linalg.norm(pts_world - world_coords, axis=1))
-        print("RMSE", np.linalg.norm(pts_world - world_coords, axis=1).mean())
+        l2 = np.linalg.norm(pts_world - world_coords, axis=1)
+        rmse = l2.mean()
+        print("l2", l2)
+        print("RMSE", rmse)
 
     with open(output, r"wb") as f:
         pickle.dump(
             {
                 "pixel2world_homography": pixel2world_homography,
-                "l2": np.linalg.norm(pts_world - world_coords, axis=1),
-                "RMSE": np.linalg.norm(pts_world - world_coords, axis=1).mean()
+                "l2": l2,
+                "RMSE": rmse
             },
             f
         )
@@ -267,31 +359,57 @@ def extrinsic_calibration(input, intrinsic, output):
 @click.option("--viz-output", "-vo", type=click.Path(exists=False), required=False, help="name of the pickle file containing intrinsic calibrations")
 @click.option('--viz/--no-viz', default=False)
 @click.option('--fisheye/--no-fisheye', default=False)
-def intrinsic_calibration(input, output, viz_output, viz, fisheye):
-    image_files = [str(p) for p in pathlib.Path(input).glob("*.JPG")]
-    intrinsic_mtx, distortion, newcameramtx, roi = _intrinsic_calibration(image_files, viz, fisheye)
+@click.option('--cache/--no-cache', default=True, help="reuse a previous calibration of the same images (not read with --viz, which recalibrates to show the detected corners)")
+@click.option('--full-res-fallback/--no-full-res-fallback', default=False, help="search images at full resolution when no board is found at half resolution (slow on images without a board)")
+def intrinsic_calibration(input, output, viz_output, viz, fisheye, cache, full_res_fallback):
+    image_files = sorted(
+        entry.path for entry in os.scandir(input)
+        if entry.is_file() and entry.name.lower().endswith((".jpg", ".jpeg"))
+    )
+    cache_file = _intrinsic_cache_file(image_files, fisheye, full_res_fallback)
+    # --viz shows corners found during calibration, so it always recalibrates
+    calibration = None
+    if cache and not viz and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                calibration = pickle.load(f)
+            print("using cached calibration", cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # unreadable or truncated cache, treat it as a miss and overwrite it
+            print("ignoring unreadable cached calibration", cache_file)
+    if calibration is None:
+        calibration = _intrinsic_calibration(image_files, viz, fisheye, full_res_fallback)
+        if cache:
+            _write_intrinsic_cache(cache_file, calibration)
+    intrinsic_mtx, distortion, newcameramtx, roi = calibration
 
     if viz:
+        # undistortion maps only depend on the image size, so build them once per size
+        maps = {}
         for fname in image_files:
             img = cv.imread(fname)
             cv.imshow('img', img)
             cv.waitKey(500)
             h, w = img.shape[:2]
+            if (w, h) not in maps:
+                if fisheye:
+                    maps[(w, h)] = _build_fisheye_maps(intrinsic_mtx, distortion, (w, h), balance=0.8)
+                elif roi is not None:
+                    maps[(w, h)] = cv.initUndistortRectifyMap(intrinsic_mtx, distortion, None, newcameramtx, (w,h), cv.CV_16SC2)
             if fisheye:
-                dst = _undistort_fisheye(img, intrinsic_mtx, distortion, balance=0.8)
+                dst = _apply_maps(img, *maps[(w, h)])
             elif roi is not None:
-                mapx, mapy = cv.initUndistortRectifyMap(intrinsic_mtx, distortion, None, newcameramtx, (w,h), 5)
-                dst = cv.remap(img, mapx, mapy, cv.INTER_LINEAR)
+                map1, map2 = maps[(w, h)]
+                dst = cv.remap(img, map1, map2, cv.INTER_LINEAR)
                 # crop the image
                 x, y, w, h = roi
                 dst = dst[y:y+h, x:x+w]
             cv.imshow('img', dst)
             cv.waitKey(500)
             if viz_output is not None:
-                print(str(pathlib.Path(viz_output) / pathlib.Path(fname).name))
-                cv.imwrite(
-                    str(pathlib.Path(viz_output) / pathlib.Path(fname).name),
-                dst)
+                viz_file = os.path.join(viz_output, os.path.basename(fname))
+                print(viz_file)
+                cv.imwrite(viz_file, dst)
 
     with open(output, r"wb") as f:
         pickle.dump(
@@ -315,9 +433,11 @@ def check_mapping(videos, input):
     cv.resizeWindow("Drawing", 800, 450)
 
     points_df = pd.read_csv(input)
+    points = points_df[["px", "py"]].to_numpy(dtype=np.int32)
     print(videos)
     for video in glob.glob(videos):
         cap = cv.VideoCapture(video)
+        video_name = os.path.basename(video)
 
         show_instruction = True
         show_points = True
@@ -326,24 +446,29 @@ def check_mapping(videos, input):
         ret, frame = cap.read()
         assert ret
         frame_index = 0
-
-        def draw_image(frame, points_df, instruction, controls, show_points = True, show_instruction=True):
-            to_draw = frame.copy()
+        # reused by draw_image so each redraw doesn't allocate a new frame
+        to_draw = np.empty_like(frame)
+
+        def draw_image(frame, points, instruction, controls, show_points = True, show_instruction=True):
+            nonlocal to_draw
+            if to_draw.shape != frame.shape:
+                to_draw = np.empty_like(frame)
+            np.copyto(to_draw, frame)
             if show_points:
-                draw_points(to_draw, points_df)
+                draw_points(to_draw, points)
             if show_instruction:
                 draw_instruction(to_draw, instruction, controls)
             return to_draw
 
-        def draw_points(frame, points_df):
-            for _, row in points_df.iterrows():
-                cv.circle(frame, (int(row["px"]), int(row["py"])), 3, (0, 255, 0), -1)
+        def draw_points(frame, points):
+            for px, py in points.tolist():
+                cv.circle(frame, (px, py), 3, (0, 255, 0), -1)
 
         def draw_instruction(frame, instruction: str, controls: str):
             cv.putText(frame, str(frame_index), (50, 50),
                 cv.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2
             )
-            cv.putText(frame, str(pathlib.Path(video).name), (200, 50),
+            cv.putText(frame, video_name, (200, 50),
                 cv.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2
             )
             cv.putText(frame, instruction, (100, 100),
@@ -357,23 +482,27 @@ def check_mapping(videos, input):
         instruction = "Watch to see if camera moves. Wait till end"
         controls = "('h'=hide;'q'=quit;scroll=zoom)"
         while True:
-            ret, _frame = cap.read()
+            # only every 30th frame is shown, so just grab (no retrieve) the others
+            if (frame_index + 1) % 30 == 0:
+                ret, _frame = cap.read()
+            else:
+                ret, _frame = cap.grab(), None
             k = -1
             if not ret:
                 instruction = "Click 'Enter'"
                 controls = "('h'=hide;'q'=quit;scroll=zoom)"
                 draw_img = draw_image(
-                    frame, points_df, instruction, controls,
+                    frame, points, instruction, controls,
                     show_points=show_points, show_instruction=show_instruction
                 )
                 cv.imshow("Drawing", draw_img)
                 k = cv.waitKey(1) 
             if ret:
-                frame = _frame
                 frame_index += 1
-                if frame_index % 30 == 0:
+                if _frame is not None:
+                    frame = _frame
                     draw_img = draw_image(
-                        frame, points_df, instruction, controls,
+                        frame, points, instruction, controls,
                         show_points=show_points, show_instruction=show_instruction
                     )
                     cv.imshow("Drawing", draw_img)
@@ -397,6 +526,10 @@ def check_mapping(videos, input):
 @click.option("--output", "-o", type=click.Path(exists=False, file_okay=False, dir_okay=False), required=True, help="name of the pickle file containing intrinsic calibrations")
 def tie_pixels_to_world(video, input, output):
     df = pd.read_csv(input, sep=',')
+    # landmarks are addressed by position, current_point indexes these
+    names = df["name"].tolist()
+    world_x = df["x"].tolist()
+    world_y = df["y"].tolist()
     cap = cv.VideoCapture(video)
     points_df = pd.DataFrame({
         "name": pd.Series(dtype=str),
@@ -419,30 +552,32 @@ def tie_pixels_to_world(video, input, output):
     ret, frame = cap.read()
     assert ret
     frame_index = 0
+    # reused by draw_image so each redraw doesn't allocate a new frame
+    to_draw = np.empty_like(frame)
 
     # functions
     def draw_map(df, current_point):
         innerW, innerH = 300, 300
         W, H = 500, 600
-        max_x = df["x"].max()
-        min_x = df["x"].min()
-        def fx(x): return (x - min_x) / (max_x - min_x) * innerW + (W - innerW) / 2
-        max_y = df["y"].max()
-        min_y = df["y"].min()
-        def fy(y): return (y - min_y) / (max_y - min_y) * innerH + (H - innerH) / 2
+        x = df["x"].to_numpy()
+        y = df["y"].to_numpy()
+        xs = ((x - x.min()) / (x.max() - x.min()) * innerW + (W - innerW) / 2).astype(int)
+        ys = ((y - y.min()) / (y.max() - y.min()) * innerH + (H - innerH) / 2).astype(int)
         blank_image = np.zeros((W, H, 3), np.uint8)
-        for idx, row in df.iterrows():
-            color = (0, 0, 255) if idx == current_point else (0, 255, 255)
-            pts = (int(fx(row.x)), int(fy(row.y)))
-            cv.circle(blank_image, pts, 3, color)
+        for i, (name, px, py) in enumerate(zip(df["name"], xs.tolist(), ys.tolist())):
+            color = (0, 0, 255) if i == current_point else (0, 255, 255)
+            cv.circle(blank_image, (px, py), 3, color)
             cv.putText(
-                blank_image, str(row["name"]), pts, cv.FONT_HERSHEY_COMPLEX,
+                blank_image, str(name), (px, py), cv.FONT_HERSHEY_COMPLEX,
                 0.5, color
             )
         return blank_image
 
     def draw_image(frame, points_df, instruction, controls, show_points = True, show_instruction=True):
-        to_draw = frame.copy()
+        nonlocal to_draw
+        if to_draw.shape != frame.shape:
+            to_draw = np.empty_like(frame)
+        np.copyto(to_draw, frame)
         if show_points:
             draw_points(to_draw, points_df)
         if show_instruction:
@@ -450,8 +585,8 @@ def tie_pixels_to_world(video, input, output):
         return to_draw
 
     def draw_points(frame, points_df):
-        for _, row in points_df.iterrows():
-            cv.circle(frame, (int(row["px"]), int(row["py"])), 3, (0, 255, 0), -1)
+        for px, py in points_df[["px", "py"]].to_numpy(dtype=np.int32).tolist():
+            cv.circle(frame, (px, py), 3, (0, 255, 0), -1)
 
     def draw_instruction(frame, instruction: str, controls: str):
         cv.putText(frame, str(frame_index), (50, 50),
@@ -466,24 +601,28 @@ def tie_pixels_to_world(video, input, output):
 
     def on_click(event, x: int, y: int, flags, params):
         if event == cv.EVENT_LBUTTONDOWN:
-            if current_point not in df.index: return
-            name: str = df.loc[current_point, "name"] # type: ignore
-            wx: float = df.loc[current_point, "x"] # type: ignore
-            wy: float = df.loc[current_point, "y"] # type: ignore
+            if not (0 <= current_point < len(df)): return
+            name: str = names[current_point]
+            wx: float = world_x[current_point]
+            wy: float = world_y[current_point]
             points_df.loc[current_point,:] = [name, wx, wy, x, y]  # type: ignore
 
     # Main Loop
     instruction = "Click on Points ('s' to skip 'j/k'=prev/next frame)"
     controls = "('h'=hide;'q'=quit;'z'=undo;scroll=zoom)"
     cv.setMouseCallback("Drawing", on_click)
+    # the map only changes when current_point does
+    map_point = None
     while True and current_point != len(df):
         points_before_loop = len(points_df)
-        map_img = draw_map(df, current_point)
+        if current_point != map_point:
+            map_img = draw_map(df, current_point)
+            cv.imshow("Map", map_img)
+            map_point = current_point
         draw_img = draw_image(
             frame, points_df, instruction, controls,
             show_points=show_points, show_instruction=show_instruction
         )
-        cv.imshow("Map", map_img)
         cv.imshow("Drawing", draw_img)
         k = cv.waitKey(5) 
         if k == 113:
@@ -528,7 +667,11 @@ def tie_pixels_to_world(video, input, output):
     instruction = "Watch to see if camera moves. Wait till end"
     controls = "('h'=hide;'q'=quit;scroll=zoom)"
     while True:
-        ret, _frame = cap.read()
+        # only every 30th frame is shown, so just grab (no retrieve) the others
+        if (frame_index + 1) % 30 == 0:
+            ret, _frame = cap.read()
+        else:
+            ret, _frame = cap.grab(), None
         k = -1
         if not ret:
             instruction = "Click 'Enter'"
@@ -540,9 +683,9 @@ def tie_pixels_to_world(video, input, output):
             cv.imshow("Drawing", draw_img)
             k = cv.waitKey(1) 
         if ret:
-            frame = _frame
             frame_index += 1
-            if frame_index % 30 == 0:
+            if _frame is not None:
+                frame = _frame
                 draw_img = draw_image(
                     frame, points_df, instruction, controls,
                     show_points=show_points, show_instruction=show_instruction